@@ -1,24 +1,74 @@
+import asyncio
+import bisect
+import hashlib
+import logging
 import os
-from fastapi import FastAPI, HTTPException
+import sys
+import time
+from contextlib import asynccontextmanager, suppress
+from functools import lru_cache
+from types import MappingProxyType
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, PrivateAttr
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Union
+import asyncpg
 import httpx
-from datetime import datetime, timezone
-from supabase import create_client, Client
+import msgspec
+import orjson
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Supabase configuration
-SUPABASE_URL = os.getenv("DELTA_SUPABASE_URL", "your-supabase-url")
-SUPABASE_KEY = os.getenv("DELTA_SUPABASE_KEY", "your-supabase-anon-key")
-
-# Initialize Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+logger = logging.getLogger(__name__)
+
+# Ergast configuration
+ERGAST_BASE_URL = "https://api.jolpi.ca/ergast/f1/"
+
+# Redis configuration (optional, caching is skipped when unset).
+# The instance is expected to run with maxmemory-policy allkeys-lfu.
+REDIS_URL = os.getenv("DELTA_REDIS_URL")
+
+# Race cache freshness: the season calendar rarely changes, but results and
+# times get updated around race weekends
+RACES_CACHE_TTL = 86400
+RACES_CACHE_TTL_RACE_WEEKEND = 600
+RACE_WEEKEND_WINDOW = timedelta(days=3)
+# Stale copies outlive the fresh ones but still expire eventually
+STALE_CACHE_TTL = 30 * 86400
+
+# HTTP caching for GET endpoints so a CDN/reverse proxy can serve repeat requests
+RACES_CACHE_CONTROL = "public, max-age=60, stale-while-revalidate=600"
+DRIVERS_CACHE_CONTROL = "public, max-age=3600"
+
+# Driver images are precomputed at startup and refreshed in the background
+DRIVER_IMAGES_REFRESH_INTERVAL = 3600
+
+# In-process race memo shared by all endpoints of a worker, keyed by year
+RACES_MEMO_TTL = 60.0
+# First F1 season; years outside [FIRST_SEASON, next year] are rejected
+FIRST_SEASON = 1950
+_race_cache: dict[int, tuple[float, "RaceSchedule"]] = {}
+# Loads in flight per year; concurrent misses await the same task
+_race_inflight: dict[int, "asyncio.Task[RaceSchedule]"] = {}
+
+# Supabase configuration: drivers are read straight from its Postgres database.
+# Without a DSN the app still serves races, and the driver endpoints return 503.
+SUPABASE_PG_DSN = os.getenv("DELTA_SUPABASE_PG_DSN")
+# asyncpg caches prepared statements, which Supabase's transaction-mode pooler
+# (port 6543) doesn't support; set this to 0 when connecting through it
+SUPABASE_PG_STATEMENT_CACHE_SIZE = int(os.getenv("DELTA_SUPABASE_PG_STATEMENT_CACHE_SIZE", "100"))
+
+DRIVERS_QUERY = (
+    "SELECT driver_code, cost, driver_name, team_name, delta_cost, driver_image, "
+    "team_image, color_main, color_accent, color_secondary FROM drivers"
+)
 
 # Country code mapping
-COUNTRY_CODE_MAP = {
+_COUNTRY_CODES = {
     "Australia": "au",
     "Bahrain": "bh",
     "Saudi Arabia": "sa",
@@ -42,6 +92,8 @@ COUNTRY_CODE_MAP = {
     "UAE": "ae",
     "USA": "us",
 }
+# Read-only view with interned keys and values
+COUNTRY_CODE_MAP = MappingProxyType({sys.intern(country): sys.intern(code) for country, code in _COUNTRY_CODES.items()})
 
 
 
@@ -56,6 +108,33 @@ class Race(BaseModel):
     date: str
     year: int
 
+    # Parsed once on construction and never serialized
+    _parsed_date: datetime = PrivateAttr()
+
+    def model_post_init(self, __context: Any) -> None:
+        self._parsed_date = parse_race_date(self.date)
+
+
+class RaceSchedule(NamedTuple):
+    """A season's races, their JSON body, its digest and lookup indexes built once per fetch"""
+    races: List[Race]
+    body: bytes
+    digest: str
+    by_round: Dict[int, Race]
+    dates: List[datetime]
+
+    @classmethod
+    def build(cls, body: bytes) -> "RaceSchedule":
+        races = [Race.model_validate(race) for race in orjson.loads(body)]
+        return cls(
+            races=races,
+            body=body,
+            digest=body_digest(body),
+            by_round={race.id: race for race in races},
+            dates=[race._parsed_date for race in races],
+        )
+
+
 
 class DriverColors(BaseModel):
     main: str
@@ -73,40 +152,91 @@ class Driver(BaseModel):
     colors: DriverColors;
 
 
-class ErgastLocation(BaseModel):
-    lat: str
-    long: str
-    locality: str
+# Ergast models are internal msgspec structs decoded straight from the
+# response bytes; they only declare the fields we read and ignore the rest
+class ErgastLocation(msgspec.Struct):
     country: str
 
-class ErgastCircuit(BaseModel):
-    circuitId: str
-    url: str
+class ErgastCircuit(msgspec.Struct):
     circuitName: str
     Location: ErgastLocation
 
-class ErgastRace(BaseModel):
+class ErgastRace(msgspec.Struct):
     season: str
     round: str
-    url: str
     raceName: str
     Circuit: ErgastCircuit
     date: str
     time: Optional[str] = None
 
-class ErgastRaceTable(BaseModel):
-    season: str
+class ErgastRaceTable(msgspec.Struct):
     Races: List[ErgastRace]
 
-class ErgastMRData(BaseModel):
+class ErgastMRData(msgspec.Struct):
     RaceTable: ErgastRaceTable
 
-class ErgastResponse(BaseModel):
+class ErgastResponse(msgspec.Struct):
     MRData: ErgastMRData
 
 
 
-app = FastAPI(title = "Delta F1 API", version= "1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ergast_client = None
+    app.state.redis = None
+    app.state.pg = None
+    app.state.driver_images_bytes = None
+    app.state.driver_images_etag = None
+    app.state.driver_images_task = None
+    refresh_task = None
+    try:
+        # Share one pooled HTTP/2 client so concurrent Ergast calls multiplex over
+        # kept-alive connections
+        app.state.ergast_client = httpx.AsyncClient(
+            base_url=ERGAST_BASE_URL,
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=60.0),
+            http2=True,
+        )
+        app.state.redis = Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+        if SUPABASE_PG_DSN:
+            try:
+                app.state.pg = await asyncpg.create_pool(
+                    dsn=SUPABASE_PG_DSN,
+                    min_size=2,
+                    max_size=10,
+                    statement_cache_size=SUPABASE_PG_STATEMENT_CACHE_SIZE,
+                )
+            except Exception as e:
+                raise RuntimeError(f"Could not connect to the database in DELTA_SUPABASE_PG_DSN: {str(e)}") from e
+
+            try:
+                await refresh_driver_images(app)
+            except HTTPException:
+                # Loaded on the first request instead
+                pass
+            refresh_task = asyncio.create_task(
+                refresh_driver_images_periodically(app, DRIVER_IMAGES_REFRESH_INTERVAL)
+            )
+        else:
+            logger.warning("DELTA_SUPABASE_PG_DSN is not set, driver endpoints are disabled")
+
+        yield
+    finally:
+        if refresh_task is not None:
+            refresh_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await refresh_task
+        if app.state.ergast_client is not None:
+            await app.state.ergast_client.aclose()
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
+        if app.state.pg is not None:
+            await app.state.pg.close()
+
+
+app = FastAPI(title = "Delta F1 API", version= "1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -121,6 +251,18 @@ app.add_middleware(
 async def root():
     return {"message": "Delta F1 API is running!"}
 
+def body_digest(body: bytes) -> str:
+    """Short content hash of a response body, used to build ETags"""
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
+
+def parse_race_date(date: str) -> datetime:
+    """Parse a race date, treating dates without an offset as UTC"""
+    parsed = datetime.fromisoformat(date)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+@lru_cache(maxsize=64)
 def get_country_code(country: str) -> str:
     """Get country code from country name"""
     return COUNTRY_CODE_MAP.get(country, "F1")
@@ -129,11 +271,8 @@ def get_country_code(country: str) -> str:
 
 
 
-def transform_ergast_race_to_race(ergast_race: ErgastRace, index: int) -> Race:
+def transform_ergast_race_to_race(ergast_race: ErgastRace) -> Race:
     """Transform Ergast API race data to our Race model"""
-    race_date = datetime.fromisoformat(ergast_race.date)
-    today = datetime.now()
-    
     return Race(
         id=int(ergast_race.round),
         round=int(ergast_race.round),
@@ -145,120 +284,270 @@ def transform_ergast_race_to_race(ergast_race: ErgastRace, index: int) -> Race:
         year=int(ergast_race.season),
     )
 
-async def fetch_drivers_from_supabase() -> List[Driver]:
-    """Fetch drivers from Supabase database"""
+@lru_cache(maxsize=128)
+def get_driver_colors(main: str, accent: str, secondary: Optional[str] = None) -> DriverColors:
+    """Get the DriverColors for a color combination, building it only once"""
+    return DriverColors(main=main, accent=accent, secondary=secondary)
+
+def transform_supabase_driver_to_driver(driver_data: asyncpg.Record) -> Driver:
+    """Transform a Supabase drivers row to our Driver model"""
+    return Driver(
+        driverCode=driver_data['driver_code'],
+        cost=float(driver_data['cost']),
+        driverName=driver_data['driver_name'],
+        teamName=driver_data['team_name'],
+        deltaCost=float(driver_data['delta_cost']),
+        driverImage=driver_data['driver_image'] or '',
+        teamImage=driver_data['team_image'] or '',
+        # Reuse the DriverColors object shared with teammates
+        colors=get_driver_colors(driver_data['color_main'], driver_data['color_accent'], driver_data['color_secondary']),
+    )
+
+async def fetch_drivers_from_supabase(pool: Optional[asyncpg.Pool]) -> List[Driver]:
+    """Fetch drivers from the Supabase Postgres database"""
+    if pool is None:
+        raise HTTPException(status_code=503, detail="Drivers database is not configured")
+
     try:
-        # Query the drivers table
-        response = supabase.table('drivers').select('*').execute()
-        
-        drivers = []
-        for driver_data in response.data:
-            # Create DriverColors object
-            colors = DriverColors(
-                main=driver_data['color_main'],
-                accent=driver_data['color_accent'],
-                secondary=driver_data.get('color_secondary')
-            )
-            
-            # Create Driver object
-            driver = Driver(
-                driverCode=driver_data['driver_code'],
-                cost=float(driver_data['cost']),
-                driverName=driver_data['driver_name'],
-                teamName=driver_data['team_name'],
-                deltaCost=float(driver_data['delta_cost']),
-                driverImage=driver_data.get('driver_image', ''),
-                teamImage=driver_data.get('team_image', ''),
-                colors=colors
-            )
-            drivers.append(driver)
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(DRIVERS_QUERY)
         
-        return drivers
+        return [transform_supabase_driver_to_driver(driver_data) for driver_data in rows]
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching drivers from database: {str(e)}")
 
 
-async def fetch_races_from_ergast(year: int | None = None) -> List[Race]:
-    """Fetch races from Ergast API"""
+async def fetch_races_from_ergast(client: httpx.AsyncClient, year: int | None = None) -> List[Race]:
+    """Fetch races from Ergast API using the shared client"""
     if year is None:
         year = datetime.now().year
     
-    url = f"https://api.jolpi.ca/ergast/f1/{year}.json"
-    
-    async with httpx.AsyncClient() as client:
+    try:
+        response = await client.get(f"{year}.json")
+        response.raise_for_status()
+        
+        ergast_data = msgspec.json.decode(response.content, type=ErgastResponse)
+        races = list(map(transform_ergast_race_to_race, ergast_data.MRData.RaceTable.Races))
+        
+        return races
+        
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=503, detail=f"Failed to fetch races from Ergast API: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing race data: {str(e)}")
+
+async def cached_json(
+    redis: Optional[Redis],
+    key: str,
+    ttl: Union[int, Callable[[Any], int]],
+    loader: Callable[[], Awaitable[Any]],
+) -> bytes:
+    """
+    Return the JSON-encoded body cached under key, calling loader on a miss.
+
+    A longer-lived copy is kept under "stale:<key>" and served when the
+    loader fails with a 503 (upstream unavailable). Redis errors are treated
+    as cache misses so an outage only costs the cache, not the endpoint.
+    """
+    if redis is not None:
+        try:
+            cached = await redis.get(key)
+        except RedisError:
+            redis = None
+        else:
+            if cached is not None:
+                return cached
+
+    try:
+        value = await loader()
+    except HTTPException as e:
+        if redis is None or e.status_code != 503:
+            raise
         try:
-            response = await client.get(url, timeout=10.0)
-            response.raise_for_status()
-            
-            ergast_data = ErgastResponse(**response.json())
-            races = [
-                transform_ergast_race_to_race(race, i) 
-                for i, race in enumerate(ergast_data.MRData.RaceTable.Races)
-            ]
-            
-            return races
-            
-        except httpx.HTTPError as e:
-            raise HTTPException(status_code=503, detail=f"Failed to fetch races from Ergast API: {str(e)}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error processing race data: {str(e)}")
+            stale = await redis.get(f"stale:{key}")
+        except RedisError:
+            stale = None
+        if stale is None:
+            raise
+        return stale
+
+    body = orjson.dumps(value)
+    if redis is not None:
+        try:
+            await redis.set(key, body, ex=ttl(value) if callable(ttl) else ttl)
+            await redis.set(f"stale:{key}", body, ex=STALE_CACHE_TTL)
+        except RedisError:
+            pass
+    return body
+
+def races_cache_ttl(races: List[dict]) -> int:
+    """Use a short TTL when a race weekend is close, a long one otherwise"""
+    now = datetime.now(timezone.utc)
+    for race in races:
+        if abs(parse_race_date(race["date"]) - now) <= RACE_WEEKEND_WINDOW:
+            return RACES_CACHE_TTL_RACE_WEEKEND
+    return RACES_CACHE_TTL
+
+def _memoized_schedule(year: int) -> Optional[RaceSchedule]:
+    cached = _race_cache.get(year)
+    if cached is not None and time.monotonic() - cached[0] < RACES_MEMO_TTL:
+        return cached[1]
+    return None
+
+async def load_race_schedule(app: FastAPI, year: int) -> RaceSchedule:
+    """Load the race schedule for a year from Redis/Ergast and memoize it"""
+    async def load_races() -> List[dict]:
+        races = await fetch_races_from_ergast(app.state.ergast_client, year)
+        return [race.model_dump() for race in races]
+
+    body = await cached_json(app.state.redis, f"races:{year}", races_cache_ttl, load_races)
+    schedule = RaceSchedule.build(body)
+    _race_cache[year] = (time.monotonic(), schedule)
+    return schedule
+
+async def get_race_schedule(request: Request, year: Optional[int] = None) -> RaceSchedule:
+    """
+    Get the race schedule for a year from the in-process memo, falling back to Redis/Ergast.
+
+    Concurrent misses for the same year share a single upstream load.
+    """
+    if year is None:
+        year = datetime.now().year
+
+    schedule = _memoized_schedule(year)
+    if schedule is not None:
+        return schedule
+
+    task = _race_inflight.get(year)
+    if task is None:
+        task = asyncio.create_task(load_race_schedule(request.app, year))
+        _race_inflight[year] = task
+        task.add_done_callback(lambda _: _race_inflight.pop(year, None))
+
+    # Shield so a disconnecting client doesn't cancel the load for the others
+    return await asyncio.shield(task)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check whether the client's If-None-Match covers etag"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+
+def not_modified_response(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={"Cache-Control": cache_control, "ETag": etag})
+
+def cached_json_response(request: Request, body: bytes, etag: str, cache_control: str) -> Response:
+    """Return a JSON body with Cache-Control and an ETag, answering 304 when the client's copy matches"""
+    if etag_matches(request, etag):
+        return not_modified_response(etag, cache_control)
+    headers = {"Cache-Control": cache_control, "ETag": etag}
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/api/races", response_model=List[Race])
-async def get_races(year: Optional[int] = None):
+async def get_races(request: Request, year: Optional[int] = None):
     """
     Get F1 races for the specified year (defaults to current year)
     
     - **year**: Year to get races for (optional, defaults to current year)
     """
-    races = await fetch_races_from_ergast(year)
-    return races
+    # year keys the race caches, so keep it to seasons that can exist
+    if year is not None and not FIRST_SEASON <= year <= datetime.now().year + 1:
+        raise HTTPException(status_code=422, detail=f"Year must be between {FIRST_SEASON} and next year")
+    schedule = await get_race_schedule(request, year)
+    # Serve the cached body as-is to skip per-request serialization
+    return cached_json_response(request, schedule.body, f'"{schedule.digest}"', RACES_CACHE_CONTROL)
 
 # Driver endpoint
 @app.get("/api/drivers", response_model=List[Driver])
-async def get_drivers():
+async def get_drivers(request: Request):
     """
     Get F1 drivers from the database
     """
-    drivers = await fetch_drivers_from_supabase()
-    return drivers
+    drivers = await fetch_drivers_from_supabase(request.app.state.pg)
+    body = orjson.dumps([driver.model_dump() for driver in drivers])
+    return cached_json_response(request, body, f'"{body_digest(body)}"', DRIVERS_CACHE_CONTROL)
+
+async def load_driver_images_body(pool: Optional[asyncpg.Pool]) -> bytes:
+    """Build the JSON body mapping driver codes to driver images"""
+    drivers = await fetch_drivers_from_supabase(pool)
+    return orjson.dumps({driver.driverCode: driver.driverImage for driver in drivers if driver.driverImage})
+
+async def refresh_driver_images(app: FastAPI) -> bytes:
+    """Rebuild the driver images body and its ETag and publish them on app.state"""
+    body = await load_driver_images_body(app.state.pg)
+    app.state.driver_images_etag = f'"{body_digest(body)}"'
+    app.state.driver_images_bytes = body
+    return body
+
+async def refresh_driver_images_periodically(app: FastAPI, interval: float):
+    """Rebuild the driver images body every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_driver_images(app)
+        except HTTPException:
+            # Keep serving the previous body until the next refresh
+            pass
+
+async def get_driver_images_body(app: FastAPI) -> bytes:
+    """
+    Get the precomputed driver images body, loading it if startup couldn't.
+
+    Concurrent requests on a cold start share a single load.
+    """
+    body = app.state.driver_images_bytes
+    if body is not None:
+        return body
+
+    task = app.state.driver_images_task
+    if task is None:
+        task = app.state.driver_images_task = asyncio.create_task(refresh_driver_images(app))
+        task.add_done_callback(lambda _: setattr(app.state, "driver_images_task", None))
+
+    # Shield so a disconnecting client doesn't cancel the load for the others
+    return await asyncio.shield(task)
 
 @app.get("/api/drivers/images")
-async def get_driver_images():
-    drivers = await fetch_drivers_from_supabase()
-    return {driver.driverCode: driver.driverImage for driver in drivers if driver.driverImage}
+async def get_driver_images(request: Request):
+    body = await get_driver_images_body(request.app)
+    return cached_json_response(request, body, request.app.state.driver_images_etag, DRIVERS_CACHE_CONTROL)
 
 
 @app.get("/api/races/upto", response_model =List[Race])
-async def get_upto_next_races(): 
+async def get_upto_next_races(request: Request, response: Response): 
     """
     Get F1 races for the current year up to the next race based on the current date. Returns in reverse order.
     """
 
-    races = await get_races()
-    current_date = datetime.now(timezone.utc)
-    added = False
-    output = []
+    schedule = await get_race_schedule(request)
+    # Races are in calendar order: take every past race plus the next one
+    index = bisect.bisect_right(schedule.dates, datetime.now(timezone.utc))
+    # The output only depends on the schedule and the split point
+    etag = f'"{schedule.digest}-upto-{index}"'
+    if etag_matches(request, etag):
+        return not_modified_response(etag, RACES_CACHE_CONTROL)
 
-    for race in races:
-        if datetime.fromisoformat(race.date) <= current_date:
-            output.append(race)
-        else:
-            if not added:
-                output.append(race)
-                added = True
-    
+    output = schedule.races[:index + 1]
     output.reverse()
 
+    response.headers["Cache-Control"] = RACES_CACHE_CONTROL
+    response.headers["ETag"] = etag
     return output
 
 @app.get("/api/race/{round}", response_model=Race)
-async def get_race(round: int):
+async def get_race(request: Request, response: Response, round: int):
     """Get a specific race by ID"""
-    races = await get_races()
-    
-    for race in races:
-        if race.id == round:
-            return race
-    
-    raise HTTPException(status_code=404, detail="Race not found")
\ No newline at end of file
+    schedule = await get_race_schedule(request)
+    race = schedule.by_round.get(round)
+    if race is None:
+        raise HTTPException(status_code=404, detail="Race not found")
+
+    etag = f'"{schedule.digest}-{round}"'
+    if etag_matches(request, etag):
+        return not_modified_response(etag, RACES_CACHE_CONTROL)
+    response.headers["Cache-Control"] = RACES_CACHE_CONTROL
+    response.headers["ETag"] = etag
+    return race